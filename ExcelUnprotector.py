@@ -1,10 +1,14 @@
 # Import packages
 import os
+import re
+import copy
+import contextlib
+import mmap
+import struct
 import zipfile
-import shutil
-import tempfile
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from xml.parsers import expat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 
 __author__ = "Nguyen Trung Hieu"
 __email__ = "trunghieuth10@gmail.com"
@@ -15,109 +19,254 @@ ExcelUnprotector: This script unlocks protected sheets in Excel files (.xls, .xl
 You can specify files or directories via command line arguments, or use a graphical file chooser dialog if no arguments are provided.
 """
 
-# Initialize dictionary to store imported modules
-installed_modules = {}
-
-# Function to automatically install and import missing packages
-def install_and_import(package):
-    import importlib
-    import subprocess
-    if package not in installed_modules:
-        try:
-            installed_modules[package] = importlib.import_module(package)
-        except ImportError:
-            subprocess.check_call(['pip', 'install', package])
-            installed_modules[package] = importlib.import_module(package)
-    return installed_modules[package]
-
-# Install and import necessary libraries
-lxml = install_and_import('lxml')
-tqdm = install_and_import('tqdm')
-from lxml import etree
-from tqdm import tqdm
-
-# Set up logging configuration
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("unlock_excel.log"),
-        logging.StreamHandler()
-    ]
+def setup_logging():
+    """
+    Set up logging configuration.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler("unlock_excel.log"),
+            logging.StreamHandler()
+        ]
+    )
+
+# Buffer size of the input and output archive files, to batch the small header reads and writes
+IO_BUFSIZE = 1024 * 1024
+
+# Largest pool ProcessPoolExecutor accepts on Windows
+MAX_WINDOWS_WORKERS = 61
+
+# Suffix added to the name of unlocked Excel files
+OUTPUT_SUFFIX = "_unprotected"
+
+# Compression level for rewritten sheets, fast with little size cost on XML
+SHEET_COMPRESSLEVEL = 1
+
+# Namespace URI of worksheet elements
+WORKSHEET_NS_URI = b'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+
+# Namespace of worksheet elements
+WORKSHEET_NS = '{' + WORKSHEET_NS_URI.decode() + '}'
+
+# Tag of the <sheetProtection> element, a direct child of the <worksheet> root
+SHEET_PROT_TAG = WORKSHEET_NS + 'sheetProtection'
+
+# Raw <sheetProtection> element, either self-closing or with a closing tag, in its schema position:
+# right after the end of <sheetData> and an optional <sheetCalcPr>
+SHEET_PROT_RE = re.compile(
+    rb'(?:</(?:\w+:)?sheetData>|<(?:\w+:)?sheetData\b(?:[^>/]|/(?!>))*/>)\s*'
+    rb'(?:<(?:\w+:)?sheetCalcPr\b(?:[^>/]|/(?!>))*/>\s*)?'
+    rb'(?P<element><(?:(?P<prefix>\w+):)?sheetProtection\b(?:[^>/]|/(?!>))*(?:/>|>[^<]*</(?(prefix)(?P=prefix):)sheetProtection>))'
 )
 
-def remove_sheet_protection(file_path, max_workers=10):
+def match_sheet_protection(data):
+    """
+    Find the worksheet-level <sheetProtection> element with a byte-level match.
+
+    :param data: Raw bytes of the sheet XML entry.
+    :return: Tuple of the start and end byte offsets of that element in data, or None if it cannot be matched safely.
+    """
+    # <sheetData> appears once, so the element can only follow its last mention
+    pos = data.rfind(b'sheetData')
+    if pos <= 0:
+        return None
+    pos = data.rfind(b'<', 0, pos)
+    match = SHEET_PROT_RE.match(data, pos)
+    if match is None:
+        return None
+
+    # Do not trust a match that sits inside a comment or CDATA section
+    if data.rfind(b'<!--', 0, pos) > data.rfind(b'-->', 0, pos) or data.rfind(b'<![CDATA[', 0, pos) > data.rfind(b']]>', 0, pos):
+        return None
+
+    # The element must be in the SpreadsheetML namespace
+    prefix = match.group('prefix')
+    declaration = b'xmlns:' + prefix if prefix else b'xmlns'
+    if declaration + b'="' + WORKSHEET_NS_URI + b'"' not in data:
+        return None
+    return match.span('element')
+
+def find_sheet_protection(data):
+    """
+    Find the <sheetProtection> element of a worksheet that is a direct child of the root.
+
+    :param data: Raw bytes of the sheet XML entry.
+    :return: Tuple of the start and end byte offsets of that element in data, or None if not found.
+    """
+    parser = expat.ParserCreate(namespace_separator='}')
+    depth = 0
+    start = None
+    span = None
+    has_content = False
+
+    def mark_content(*args):
+        nonlocal has_content
+        has_content = True
+
+    def start_element(name, attrs):
+        nonlocal depth, start, has_content
+        depth += 1
+        if start is not None:
+            has_content = True
+        elif depth == 2 and span is None and '{' + name == SHEET_PROT_TAG:
+            # Offsets reported by expat point into data, so the element can be cut out exactly
+            start = parser.CurrentByteIndex
+            has_content = False
+            # Watch for text, comments and the like only inside the element
+            parser.CharacterDataHandler = mark_content
+            parser.CommentHandler = mark_content
+            parser.ProcessingInstructionHandler = mark_content
+            parser.StartCdataSectionHandler = mark_content
+
+    def end_element(name):
+        nonlocal depth, start, span
+        if start is not None and depth == 2:
+            end = parser.CurrentByteIndex
+            # A self-closing element is reported right after its "/>", otherwise at its end tag
+            if has_content or data[end - 2:end] != b'/>':
+                end = data.index(b'>', end) + 1
+            span = (start, end)
+            start = None
+            parser.CharacterDataHandler = None
+            parser.CommentHandler = None
+            parser.ProcessingInstructionHandler = None
+            parser.StartCdataSectionHandler = None
+        depth -= 1
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.Parse(data, True)
+    return span
+
+def process_sheet(sheet_file, data):
+    """
+    Process a single sheet XML entry to remove protection.
+
+    :param sheet_file: Name of the sheet XML entry in the archive.
+    :param data: Raw bytes of the sheet XML entry.
+    :return: Bytes of the sheet XML without protection, or None if the sheet is left unchanged.
+    """
+    # Skip sheets that have no protection element
+    if b'sheetProtection' not in data:
+        return None
+
+    # Strip the <sheetProtection> element straight from the raw bytes
+    span = match_sheet_protection(data)
+    if span is not None:
+        logging.debug(f"Removed sheet protection from {sheet_file}")
+        return data[:span[0]] + data[span[1]:]
+
+    # No safe match: scan the XML to remove only the worksheet-level element
+    try:
+        span = find_sheet_protection(data)
+        if span is None:
+            return None
+        logging.debug(f"Removed sheet protection from {sheet_file}")
+        return data[:span[0]] + data[span[1]:]
+    except expat.ExpatError as e:
+        logging.error(f"Error parsing XML file {sheet_file}: {e}")
+    except Exception as e:
+        logging.error(f"An error occurred while processing sheet {sheet_file}: {e}")
+    return None
+
+def copy_raw_entry(src_view, dst, info):
+    """
+    Copy an archive entry as-is, without decompressing and recompressing it.
+
+    :param src_view: Memoryview over the memory-mapped source archive.
+    :param dst: Output ZipFile opened for writing.
+    :param info: ZipInfo of the entry in the source archive.
+    """
+    # Skip the local file header to reach the compressed data
+    # (unpacked in place, so no slice of the mapping outlives an error raised here)
+    if info.header_offset + 30 > len(src_view):
+        raise zipfile.BadZipFile(f"Truncated entry {info.filename}")
+    signature, name_length, extra_length = struct.unpack_from('<4s22xHH', src_view, info.header_offset)
+    if signature != b'PK\x03\x04':
+        raise zipfile.BadZipFile(f"Bad local file header for {info.filename}")
+    data_start = info.header_offset + 30 + name_length + extra_length
+    data_end = data_start + info.compress_size
+    if data_end > len(src_view):
+        raise zipfile.BadZipFile(f"Truncated entry {info.filename}")
+
+    # CRC and sizes are already known, so no data descriptor is written after the data
+    zinfo = copy.copy(info)
+    zinfo.flag_bits &= ~0x08
+
+    # Same bookkeeping as ZipFile.write() does for entries without data
+    with dst._lock:
+        if dst._seekable:
+            dst.fp.seek(dst.start_dir)
+        zinfo.header_offset = dst.fp.tell()
+        dst._writecheck(zinfo)
+        dst._didModify = True
+        dst.fp.write(zinfo.FileHeader())
+        # Written straight from the mapping, without an intermediate copy
+        dst.fp.write(src_view[data_start:data_end])
+        dst.filelist.append(zinfo)
+        dst.NameToInfo[zinfo.filename] = zinfo
+        dst.start_dir = dst.fp.tell()
+
+def remove_sheet_protection(file_path):
     """
     Remove sheet protection in an Excel file.
 
     :param file_path: Path to the Excel file to unlock.
-    :param max_workers: Maximum number of worker threads to use.
-    :return: Path to the unlocked Excel file.
+    :return: Path to the unlocked Excel file, or file_path itself if no sheet is protected.
     """
     logging.debug(f"Processing file: {file_path}")
-    tmp_dir = tempfile.mkdtemp()
-    output_file = file_path.replace('.xls', '_unprotected.xls')
+    base, ext = os.path.splitext(file_path)
+    output_file = f"{base}{OUTPUT_SUFFIX}{ext}"
     
     try:
         # Check if the Excel file exists
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"File not found: {file_path}")
 
-        # Unzip the Excel file to a temporary directory
-        with zipfile.ZipFile(file_path, 'r') as zip_ref:
-            zip_ref.extractall(tmp_dir)
-        logging.debug(f"Extracted {file_path} to temporary directory {tmp_dir}")
-      
-        # Find and modify sheet XML files to remove password protection
-        worksheets_dir = os.path.join(tmp_dir, 'xl', 'worksheets')
-        
-        def process_sheet(sheet_file):
-            """
-            Process a single sheet XML file to remove protection.
-
-            :param sheet_file: Name of the sheet XML file to process.
-            """
-            sheet_path = os.path.join(worksheets_dir, sheet_file)
+        with open(file_path, 'rb', buffering=IO_BUFSIZE) as raw, zipfile.ZipFile(raw, 'r') as src:
+            # Stream entries from the input archive into a temporary file next to the output,
+            # so a failure never leaves an incomplete workbook under the output name
+            tmp_file = output_file + ".tmp"
             try:
-                tree = etree.parse(sheet_path)
-                root = tree.getroot()
-
-                # Find and remove <sheetProtection> element
-                sheet_protection = root.find('.//{http://schemas.openxmlformats.org/spreadsheetml/2006/main}sheetProtection')
-                if sheet_protection is not None:
-                    sheet_protection.getparent().remove(sheet_protection)
-                    logging.debug(f"Removed sheet protection from {sheet_path}")
-
-                # Save the modified XML file
-                tree.write(sheet_path, xml_declaration=True, encoding='UTF-8', pretty_print=True)
-            except etree.XMLSyntaxError as e:
-                logging.error(f"Error parsing XML file {sheet_path}: {e}")
-            except Exception as e:
-                logging.error(f"An error occurred while processing sheet {sheet_file}: {e}")
-        
-        # List all sheet XML files and store in an array
-        sheet_files = [f for f in os.listdir(worksheets_dir) if f.endswith(".xml")]  
-
-        # Use progress bar to show the process of handling sheet XML files
-        with tqdm(total=len(sheet_files), desc=f"Processing {os.path.basename(output_file)}", dynamic_ncols=True) as pbar:
-            # Use multithreading to handle sheet XML files in the array
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                futures = [executor.submit(process_sheet, sheet_file) for sheet_file in sheet_files]
-                for future in as_completed(futures):
-                    try:
-                        future.result()
-                    except Exception as e:
-                        logging.error(f"An error occurred while processing a sheet: {e}")
-                    finally:
-                        pbar.update(1)
-
-        # Zip the files back into a new Excel file
-        with zipfile.ZipFile(output_file, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
-            for root, _, files in os.walk(tmp_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, tmp_dir)
-                    zip_ref.write(file_path, arcname)        
+                with contextlib.ExitStack() as stack:
+                    # The output is only created once a protected sheet is found,
+                    # entries before it are kept in pending until then
+                    dst = None
+                    pending = []
+                    for info in src.infolist():
+                        sheet_data = None
+                        if info.filename.startswith('xl/worksheets/') and info.filename.endswith('.xml'):
+                            sheet_data = process_sheet(info.filename, src.read(info))
+
+                        # Copy every unchanged entry with its original compression
+                        if sheet_data is None:
+                            if dst is None:
+                                pending.append(info)
+                            else:
+                                copy_raw_entry(view, dst, info)
+                            continue
+
+                        if dst is None:
+                            # Passthrough entries are copied from a read-only memory map of the input archive
+                            mm = stack.enter_context(mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ))
+                            view = stack.enter_context(memoryview(mm))
+                            out = stack.enter_context(open(tmp_file, 'wb', buffering=IO_BUFSIZE))
+                            dst = stack.enter_context(zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED, compresslevel=SHEET_COMPRESSLEVEL))
+                            for pending_info in pending:
+                                copy_raw_entry(view, dst, pending_info)
+                        dst.writestr(info, sheet_data, compresslevel=SHEET_COMPRESSLEVEL)
+
+                # Leave the workbook untouched if no sheet is protected
+                if dst is None:
+                    logging.info(f"No protected sheets found in {file_path}")
+                    return file_path
+                os.replace(tmp_file, output_file)
+            except BaseException:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+                raise
         logging.debug(f"File unprotected saved as: {output_file}")
         return output_file
         
@@ -127,48 +276,119 @@ def remove_sheet_protection(file_path, max_workers=10):
         logging.error(f"Bad Zip file: {file_path}")
     except Exception as e:
         logging.error(f"An error occurred: {e}")
-    finally:
-        # Delete temporary directory if it exists
-        if os.path.exists(tmp_dir):
-            shutil.rmtree(tmp_dir)
-            logging.debug(f"Deleted temporary directory {tmp_dir}")
 
-def unlock_excel_sheets(input_path, max_workers=None):
+def iter_excel_files(dir_path):
     """
-    Unlock protected sheets in Excel files or all Excel files in a directory.
+    Recursively yield Excel files found in a directory.
 
-    :param input_paths: Path to a file or directory containing Excel files.
-    :param max_workers: Maximum number of worker threads to use.
+    :param dir_path: Path to the directory to scan.
+    :return: Generator of paths to Excel files.
+    """
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from iter_excel_files(entry.path)
+                elif entry.name.endswith((".xls", ".xlsx", ".xlsm")) and entry.is_file():
+                    # Skip unlocked files, including the ones being written by this run
+                    if not os.path.splitext(entry.name)[0].endswith(OUTPUT_SUFFIX):
+                        yield entry.path
+    except OSError as e:
+        logging.error(f"Cannot scan directory {dir_path}: {e}")
+
+def create_executor(max_workers=None, single_file=False):
+    """
+    Create the executor used to process Excel files.
+
+    :param max_workers: Maximum number of worker processes to use.
+    :param single_file: Whether only a single file will be processed.
+    :return: A process pool, or a single thread when processes are not worth spawning.
+    """
+    if single_file:
+        return ThreadPoolExecutor(max_workers=1)
+    return ProcessPoolExecutor(max_workers=max_workers, initializer=setup_logging)
+
+def iter_input_files(input_paths):
+    """
+    Yield the Excel files given directly or found in the given directories.
+
+    :param input_paths: Paths to files or directories containing Excel files.
+    :return: Generator of paths to Excel files.
+    """
+    for input_path in input_paths:
+        if os.path.isfile(input_path) and input_path.endswith((".xls", ".xlsx", ".xlsm")):
+            # If input is an Excel file
+            yield input_path
+        elif os.path.isdir(input_path):
+            # If input is a directory, files are processed while the directory is still being scanned
+            yield from iter_excel_files(input_path)
+        else:
+            logging.error(f"Invalid input path: {input_path}")
+
+def unlock_excel_sheets(input_paths, max_workers=None):
+    """
+    Unlock protected sheets in Excel files or all Excel files in directories.
+
+    :param input_paths: Path, or list of paths, to files or directories containing Excel files.
+    :param max_workers: Maximum number of worker processes to use.
     :return: Message containing paths to the unlocked Excel files.
     """
-    excel_files = []
-    if os.path.isfile(input_path) and input_path.endswith((".xls", ".xlsx", ".xlsm")):
-        # If input is an Excel file
-        excel_files.append(input_path)
-    elif os.path.isdir(input_path):
-        # If input is a directory
-        for root, _, files in os.walk(input_path):
-            for file in files:
-                if file.endswith((".xls", ".xlsx", ".xlsm")):
-                    file_path = os.path.join(root, file)
-                    excel_files.append(file_path)
-    else:
-        logging.error(f"Invalid input path: {input_path}")
-        return
-
-    list_outfile = ""
-    if len(excel_files) > 1:
-        pbar = tqdm(total=len(excel_files), desc=f"==>Total process: {len(excel_files)} files", dynamic_ncols=True, position=0)
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(remove_sheet_protection, file_path) for file_path in excel_files]
-        for future in as_completed(futures):
+    from tqdm import tqdm
+    if isinstance(input_paths, str):
+        input_paths = [input_paths]
+
+    # All inputs are fed through one pool, so files from different paths are processed together
+    excel_files = iter_input_files(input_paths)
+    single_file = len(input_paths) == 1 and os.path.isfile(input_paths[0])
+    pbar = None
+    if not single_file:
+        pbar = tqdm(total=0, desc="==>Total process: 0 files", dynamic_ncols=True, position=0)
+
+    list_outfile = []
+    # Let the pool pick its own default size, except when fewer files than its workers are given explicitly
+    pool_workers = max_workers
+    if pool_workers is None and all(os.path.isfile(input_path) for input_path in input_paths):
+        if len(input_paths) < min(os.cpu_count() or 1, MAX_WINDOWS_WORKERS):
+            pool_workers = len(input_paths)
+    # Bound on the tasks kept in flight while discovery goes on
+    max_inflight = (max_workers or os.cpu_count() or 1) * 2
+
+    def collect(futures):
+        """
+        Collect the results of finished tasks into list_outfile.
+
+        :param futures: Finished futures of remove_sheet_protection.
+        """
+        for future in futures:
             try:
-                list_outfile += future.result() + "\n"
+                output_file = future.result()
+                # Failed files return None and have already been logged
+                if output_file is not None:
+                    list_outfile.append(output_file)
             except Exception as e:
                 logging.error(f"An error occurred while processing a file: {e}")
             finally:
-                if len(excel_files) > 1: pbar.update(1)
-    return list_outfile
+                if pbar is not None: pbar.update(1)
+
+    executor = create_executor(pool_workers, single_file=single_file)
+
+    inflight = set()
+    try:
+        for file_path in excel_files:
+            inflight.add(executor.submit(remove_sheet_protection, file_path))
+            if pbar is not None:
+                pbar.total += 1
+                pbar.set_description(f"==>Total process: {pbar.total} files")
+            # Keep a bounded number of tasks in flight while discovery goes on
+            if len(inflight) >= max_inflight:
+                done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(as_completed(inflight))
+    finally:
+        executor.shutdown()
+        if pbar is not None:
+            pbar.close()
+    return "\n".join(list_outfile)
 
 def filedialog_input():
     """
@@ -220,16 +440,21 @@ def parse_input():
     return filedialog_input()
 
 def main():
+    setup_logging()
     input_paths = parse_input()
     if not input_paths:
         exit()
+    existing_paths = []
     for input_path in input_paths:
         if os.path.exists(input_path):
-            result = unlock_excel_sheets(input_path, max_workers=None)
-            # if result:
-            #     print(f"File unprotected saved as:\n{result}")
+            existing_paths.append(input_path)
         else:
             logging.error(f"Input path does not exist: {input_path}")
+    if existing_paths:
+        # Process all input paths in a single batch
+        result = unlock_excel_sheets(existing_paths, max_workers=None)
+        # if result:
+        #     print(f"File unprotected saved as:\n{result}")
 
 if __name__ == "__main__":
     main()